@@ -5,18 +5,21 @@
 # Licensed under GPL version 2 or any later version, read the file "COPYING" for more information.
 
 import fnmatch
+import io
 import os
 import sys
 
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 
 THEME_PATH = os.path.join('.', 'share', 'icons')
-IGNORE_THEMES = [
+IGNORE_THEMES = frozenset([
     'application',
     'Tango',
-]
+])
 FALLBACK_THEME = 'hicolor'
-IGNORE_ICONS = [
+SYMBOLIC_SUFFIX = '-symbolic.svg'
+IGNORE_ICONS = frozenset([
     # These are hard coded as symbolic in the gtk source code
     'list-add-symbolic.svg',
     'list-add.svg',
@@ -68,7 +71,11 @@ IGNORE_ICONS = [
     # Those are UI elements in form of icons; themes may define them, but they shouldn't have to
     'resizing-handle-horizontal-symbolic.svg',
     'resizing-handle-vertical-symbolic.svg',
-]
+])
+# Ignored symbolic icons by the name they are compared under (-symbolic.svg turned into .svg);
+# other names are already in that form and are looked up in IGNORE_ICONS directly
+IGNORE_SYMBOLIC_NAMES = frozenset(name[:-len(SYMBOLIC_SUFFIX)] + '.svg'
+                                  for name in IGNORE_ICONS if name.endswith(SYMBOLIC_SUFFIX))
 
 NO_PROBLEM,\
 BAD_SYMBOLIC_NAME,\
@@ -77,96 +84,173 @@ MISSING_FROM,\
 ONLY_FOUND_IN = range(5)
 
 def icon_themes():
-    for name in os.listdir(THEME_PATH):
-        filename = os.path.join(THEME_PATH, name)
-        if name in IGNORE_THEMES or not os.path.isdir(filename):
-            continue
-        yield name, filename
+    with os.scandir(THEME_PATH) as it:
+        for entry in it:
+            if entry.name in IGNORE_THEMES or not entry.is_dir():
+                continue
+            yield entry.name, entry.path
+
+# Like os.walk, but keeps the DirEntry objects so file types need no extra stat
+def walk_files(path):
+    stack = [path]
+    while stack:
+        current = stack.pop()
+        files = []
+        with os.scandir(current) as it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif not entry.is_dir():
+                    files.append(entry)
+        yield current[len(path)+1:], files
 
 def theme_to_string(name, kind):
     return f"{name}-{kind}"
 
-def find_errors_in(themes):
-    errors = []
-    warnings = []
+# Each theme i gets two bits in an icon's mask: 1 << 2i when the icon is in its
+# symbolic directory and 1 << 2i+1 when it is in its scalable directory.
+def theme_bits(index):
+    return 1 << (2 * index), 1 << (2 * index + 1)
+
+def theme_names_in(mask, names):
+    # Names of the themes whose symbolic bit is set in mask
+    while mask:
+        low = mask & -mask
+        yield names[low.bit_length() // 2]
+        mask ^= low
+
+def add_symbolic_dir(root, files, bit, data, bad):
+    for entry in files:
+        fname = entry.name
+        if fname[-4:] != '.svg':
+            continue
+        if fname[-len(SYMBOLIC_SUFFIX):] != SYMBOLIC_SUFFIX:
+            if fname not in IGNORE_ICONS:
+                bad.append(entry.path)
+            continue
+
+        # Make filenames consistant for comparison
+        fname = fname[:-len(SYMBOLIC_SUFFIX)] + '.svg'
+        if fname in IGNORE_SYMBOLIC_NAMES:
+            continue
+        # root is relative and never empty, a plain '/' is fine for comparison and reporting
+        filename = f"{root}/{fname}"
+        data[filename] = data.get(filename, 0) | bit
 
-    data = defaultdict(set)
+def add_scalable_dir(root, files, bit, data, bad):
+    for entry in files:
+        fname = entry.name
+        if fname[-4:] != '.svg':
+            continue
+        if fname[-len(SYMBOLIC_SUFFIX):] == SYMBOLIC_SUFFIX:
+            if fname not in IGNORE_ICONS:
+                bad.append(entry.path)
+            continue
+        if fname in IGNORE_ICONS:
+            continue
+
+        filename = f"{root}/{fname}"
+        data[filename] = data.get(filename, 0) | bit
+
+def scan_theme(index, name, path):
+    data = {}
     bad_symbolic = []
     bad_scalable = []
-    all_symbolics = set()
+    has_symbolic = False
 
-    for name, path in themes:
-        for root, dirs, files in os.walk(path):
-            orig = root
-            root = root[len(path)+1:]
-            if '/' not in root:
-                continue
-            (kind, root) = root.split('/', 1)
-            if kind not in ("symbolic", "scalable"):
-                continue # Not testing cursors, maybe later.
+    # Not testing cursors or fixed size icons, maybe later.
+    for kind, bit in zip(("symbolic", "scalable"), theme_bits(index)):
+        kind_root = os.path.join(path, kind)
+        if not os.path.isdir(kind_root) or os.path.islink(kind_root):
+            continue
+        for root, files in walk_files(kind_root):
+            if not root:
+                continue # Icons must be in a context sub-directory
 
-            theme_name = (name, kind)
             if kind == "symbolic":
-                all_symbolics.add(name)
-
-            for fname in files:
-                if fname in IGNORE_ICONS:
-                    continue
-                if not fname.endswith('.svg'):
-                    continue
-
-                if kind == "symbolic":
-                    if not fname.endswith('-symbolic.svg'):
-                        bad_symbolic.append(os.path.join(orig, fname))
-                        continue
-                    else:
-                        # Make filenames consistant for comparison
-                        fname = fname.replace('-symbolic.svg', '.svg')
-                elif kind == "scalable" and fname.endswith('-symbolic.svg'):
-                    bad_scalable.append(os.path.join(orig, fname))
-                    continue
-
-                filename = os.path.join(root, fname)
-                data[filename].add(theme_name)
+                has_symbolic = True
+                add_symbolic_dir(root, files, bit, data, bad_symbolic)
+            else:
+                add_scalable_dir(root, files, bit, data, bad_scalable)
 
-    if bad_symbolic:
-        errors.append((BAD_SYMBOLIC_NAME, bad_symbolic))
-    if bad_scalable:
-        errors.append((BAD_SCALABLE_NAME, bad_scalable))
+    return data, bad_symbolic, bad_scalable, has_symbolic
 
+# Sort each (filename, mask) pair into the missing/only found/warning buckets.
+# Only plain ints and strings go in and out, so this loop stays cheap.
+def check_icon_masks(items, names, all_symbolics, fallback_bit, symbolic_bits):
     only_found_in = defaultdict(list)
     missing_from = defaultdict(list)
     warn_missing_from = defaultdict(list)
 
-    for filename in sorted(data):
-        datum = data[filename]
+    scalable_bits = symbolic_bits << 1
 
-        symbolics = set(name for (name, kind) in datum if kind == 'symbolic')
-        scalables = set(name for (name, kind) in datum if kind == 'scalable')
+    for filename, mask in items:
+        symbolics = mask & symbolic_bits
 
         # For every scalable, there must be a symbolic
-        diff = scalables - symbolics
-        if len(diff) > 0:
-            for name in diff:
-                missing_from[f"{name}-symbolic"].append(filename)
-            continue
+        # (many icons are symbolic only, skip the comparison for those)
+        if mask & scalable_bits:
+            # Scalable bits moved onto the matching theme's symbolic bit
+            diff = (mask >> 1) & symbolic_bits & ~symbolics
+            if diff:
+                for name in theme_names_in(diff, names):
+                    missing_from[f"{name}-symbolic"].append(filename)
+                continue
 
         # Icon present in all themes => no error
         if symbolics == all_symbolics:
             continue
 
         # Icon present in fallback theme but missing from some other theme => warning
-        if FALLBACK_THEME in symbolics:
-            for name in all_symbolics - symbolics:
+        if symbolics & fallback_bit:
+            for name in theme_names_in(all_symbolics & ~symbolics, names):
                 warn_missing_from[name].append(filename)
             continue
 
         # Icon present in some theme but not fallback => error
-        if len(datum) == 1:
-            only_found_in[theme_to_string(*list(datum)[0])].append(filename)
+        # (a single bit set means a single symbolic theme, scalables were handled above)
+        if mask & (mask - 1) == 0:
+            only_found_in[theme_to_string(next(theme_names_in(mask, names)), "symbolic")].append(filename)
             continue
         missing_from[FALLBACK_THEME].append(filename)
 
+    return missing_from, only_found_in, warn_missing_from
+
+def find_errors_in(themes):
+    errors = []
+    warnings = []
+
+    data = {}
+    bad_symbolic = []
+    bad_scalable = []
+    all_symbolics = 0
+
+    # Themes are independent, walk them concurrently and merge the results here
+    themes = list(themes)
+    names = [name for (name, path) in themes]
+    paths = [path for (name, path) in themes]
+    with ThreadPoolExecutor(max_workers=len(themes) or 1) as executor:
+        results = list(executor.map(scan_theme, range(len(themes)), names, paths))
+
+    for index, (theme_data, theme_bad_symbolic, theme_bad_scalable, has_symbolic) in enumerate(results):
+        for filename, mask in theme_data.items():
+            data[filename] = data.get(filename, 0) | mask
+        bad_symbolic += theme_bad_symbolic
+        bad_scalable += theme_bad_scalable
+        if has_symbolic:
+            all_symbolics |= theme_bits(index)[0]
+
+    if bad_symbolic:
+        errors.append((BAD_SYMBOLIC_NAME, bad_symbolic))
+    if bad_scalable:
+        errors.append((BAD_SCALABLE_NAME, bad_scalable))
+
+    symbolic_bits = sum(theme_bits(index)[0] for index in range(len(themes)))
+    fallback_bit = theme_bits(names.index(FALLBACK_THEME))[0] if FALLBACK_THEME in names else 0
+
+    missing_from, only_found_in, warn_missing_from = check_icon_masks(
+        sorted(data.items()), names, all_symbolics, fallback_bit, symbolic_bits)
+
     if only_found_in:
         errors.append((ONLY_FOUND_IN, only_found_in))
     if missing_from:
@@ -178,53 +262,47 @@ def find_errors_in(themes):
 
 if __name__ == '__main__':
     errors, warnings = find_errors_in(icon_themes())
+    output = io.StringIO()
     if errors:
         count = 0
-        for error, themes in errors:
-            if isinstance(themes, list):
-                count += len(themes)
-            elif isinstance(themes, dict):
-                count += sum([len(v) for v in themes.values()])
-        sys.stderr.write(f" == {count} errors found in icon themes! == \n\n")
+        body = io.StringIO()
         for error, themes in errors:
             if error is BAD_SCALABLE_NAME:
-                sys.stderr.write(f"Scalable themes should not have symbolic icons in them (They end with -symbolic.svg so won't be used):\n")
-                for name in themes:
-                    sys.stderr.write(f" - {name}\n")
-                sys.stderr.write("\n")
+                count += len(themes)
+                body.write(f"Scalable themes should not have symbolic icons in them (They end with -symbolic.svg so won't be used):\n")
+                body.write("".join(f" - {name}\n" for name in themes) + "\n")
             elif error is BAD_SYMBOLIC_NAME:
-                sys.stderr.write(f"Symbolic themes should only have symbolic icons in them (They don't end with -symbolic.svg so can't be used):\n")
-                for name in themes:
-                    sys.stderr.write(f" - {name}\n")
-                sys.stderr.write("\n")
+                count += len(themes)
+                body.write(f"Symbolic themes should only have symbolic icons in them (They don't end with -symbolic.svg so can't be used):\n")
+                body.write("".join(f" - {name}\n" for name in themes) + "\n")
             elif error is MISSING_FROM:
                 for theme in themes:
-                    sys.stderr.write(f"Icons missing from {theme}:\n")
-                    for name in themes[theme]:
-                        sys.stderr.write(f" - {name}\n")
-                    sys.stderr.write("\n")
+                    count += len(themes[theme])
+                    body.write(f"Icons missing from {theme}:\n")
+                    body.write("".join(f" - {name}\n" for name in themes[theme]) + "\n")
             elif error is ONLY_FOUND_IN:
                 for theme in themes:
-                    sys.stderr.write(f"Icons only found in {theme}:\n")
-                    for name in themes[theme]:
-                        sys.stderr.write(f" + {name}\n")
-                    sys.stderr.write("\n")
+                    count += len(themes[theme])
+                    body.write(f"Icons only found in {theme}:\n")
+                    body.write("".join(f" + {name}\n" for name in themes[theme]) + "\n")
             else:
                 pass
+        output.write(f" == {count} errors found in icon themes! == \n\n")
+        output.write(body.getvalue())
     if warnings:
         count = 0
-        for warning, themes in warnings:
-            count += sum([len(v) for v in themes.values()])
-        sys.stderr.write(f" == {count} warnings found in icon themes == \n\n")
+        body = io.StringIO()
         for warning, themes in warnings:
             if warning is MISSING_FROM:
                 for theme in themes:
-                    sys.stderr.write(f"Icons missing from {theme}:\n")
-                    for name in themes[theme]:
-                        sys.stderr.write(f" - {name}\n")
-                    sys.stderr.write("\n")
+                    count += len(themes[theme])
+                    body.write(f"Icons missing from {theme}:\n")
+                    body.write("".join(f" - {name}\n" for name in themes[theme]) + "\n")
             else:
                 pass
+        output.write(f" == {count} warnings found in icon themes == \n\n")
+        output.write(body.getvalue())
+    sys.stderr.write(output.getvalue())
     if errors:
         sys.exit(5)
 